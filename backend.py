@@ -1,7 +1,10 @@
+import atexit
+import math
+import os
 import pymongo
-from flask import Flask, jsonify, request # Import Flask for web server, jsonify to send data, request to get parameters
-from datetime import datetime, timezone, timedelta
-import geojson # To format output for maps
+from flask import Flask, Response, jsonify, request # Import Flask for web server, jsonify to send data, request to get parameters
+import orjson # Fast C JSON encoder for the large GeoJSON payloads
+import ciso8601 # Fast C ISO-8601 parser for query-param timestamps (handles the 'Z' suffix)
 
 # --- Flask App Setup ---
 app = Flask(__name__) # Initialize the Flask app
@@ -11,134 +14,214 @@ MONGO_CONNECTION_STRING = "mongodb://localhost:27017/"
 DB_NAME = "stormsight_db"
 TRACK_COLLECTION_NAME = "track_data"
 
-# Global variable for DB connection (better ways exist, but simple for prototype)
-db_client = None
-track_collection = None
+# Single client created at import time; PyMongo keeps a thread-safe connection pool behind it,
+# so every request (and every server thread) reuses the same warm connections.
+db_client = pymongo.MongoClient(MONGO_CONNECTION_STRING, maxPoolSize=50, minPoolSize=5, serverSelectionTimeoutMS=3000)
+track_collection = db_client[DB_NAME][TRACK_COLLECTION_NAME]
+atexit.register(db_client.close) # Close pooled connections on interpreter shutdown
 
 def get_db_collection():
-    """Connects to MongoDB and returns the track collection"""
-    global db_client, track_collection
-    if track_collection is None:
-        try:
-            print("Connecting to MongoDB for API...")
-            db_client = pymongo.MongoClient(MONGO_CONNECTION_STRING, serverSelectionTimeoutMS=3000)
-            db_client.admin.command('ismaster') # Check connection
-            db = db_client[DB_NAME]
-            track_collection = db[TRACK_COLLECTION_NAME]
-            print("MongoDB connection successful for API.")
-        except Exception as e:
-            print(f"ERROR: Could not connect to MongoDB for API. {e}")
-            track_collection = None # Ensure it's None on failure
+    """Returns the track collection handle backed by the shared connection pool"""
     return track_collection
 
-# --- API Endpoints ---
-
-@app.route('/') # Default route
-def index():
-    return "StormSight AI Prototype Backend is running!"
-
-@app.route('/track_data') # Route to get track data
-def get_track_data():
+# --- Query Helpers ---
+
+# Only the fields a GeoJSON Feature needs are projected (no _id / latitude / longitude duplicates),
+# so less BSON crosses the wire and PyMongo has less to decode. Built once and shared by every query.
+FEATURE_PROJECTION = {
+    "_id": 0,
+    "type": {"$literal": "Feature"},
+    "geometry": "$location", # Use the pre-formatted GeoJSON location
+    "properties": {
+        # Same string format clients got before
+        "timestamp": {"$dateToString": {"format": "%Y-%m-%dT%H:%M:%SZ", "date": "$timestamp"}},
+        # $ifNull keeps missing fields as null (like the old .get()) instead of dropping the key
+        "wind_kts": {"$ifNull": ["$wind_kts", None]},
+        "pressure_mb": {"$ifNull": ["$pressure_mb", None]},
+        "storm_id": {"$ifNull": ["$storm_id", None]},
+        # Add more properties if needed
+    },
+}
+
+def feature_pipeline(query, sort_direction=pymongo.ASCENDING, limit=None):
     """
-    Fetches track data from MongoDB based on optional time parameters.
-    Returns data as a GeoJSON FeatureCollection.
-    Example query: /track_data?timestamp=2020-11-25T12:00:00Z
-                   /track_data?start=2020-11-24T00:00:00Z&end=2020-11-26T00:00:00Z
+    Builds an aggregation pipeline that returns track points already shaped as GeoJSON Features,
+    so MongoDB does the reshaping instead of Python.
+    """
+    if "location" not in query:
+        # Only create features if geometry exists (a bbox filter on "location" already implies it)
+        query = {**query, "location": {"$ne": None}}
+    pipeline = [
+        {"$match": query},
+        # storm_id is always an equality match, so this sorts like {timestamp: d} alone; listing both keys
+        # just spells out the "storm_time" index order the sort is served from (no SORT stage either way).
+        {"$sort": {"storm_id": sort_direction, "timestamp": sort_direction}},
+    ]
+    if limit is not None:
+        pipeline.append({"$limit": limit})
+    pipeline.append({"$project": FEATURE_PROJECTION})
+    return pipeline
+
+def build_track_pipelines(args):
+    """
+    Turns the request's query parameters into the aggregation pipeline(s) to run.
+    Pipelines are returned in fallback order: run the next one only if the previous matched nothing.
+    Raises ValueError (with a message for the client) if a time or bbox parameter is malformed.
     """
-    collection = get_db_collection()
-    if not collection:
-        return jsonify({"error": "Database connection failed"}), 500
-
     query = {} # Start with empty query (get all data)
-    features = [] # List to hold GeoJSON features
 
     # Get query parameters from the URL (if provided)
-    timestamp_param = request.args.get('timestamp')
-    start_time_param = request.args.get('start')
-    end_time_param = request.args.get('end')
-    storm_id_param = request.args.get('storm_id', "BESTTRACK_2020") # Default to our loaded storm
+    timestamp_param = args.get('timestamp')
+    start_time_param = args.get('start')
+    end_time_param = args.get('end')
+    storm_id_param = args.get('storm_id', "BESTTRACK_2020") # Default to our loaded storm
+    bbox_param = args.get('bbox') # minLon,minLat,maxLon,maxLat
 
     # Filter by storm ID
     query["storm_id"] = storm_id_param
 
+    # --- Spatial Filtering Logic ---
+    if bbox_param:
+        # Bounding box as a closed polygon, so $geoWithin can use the 2dsphere index on "location"
+        bbox_error = ("Invalid bbox format. Use bbox=minLon,minLat,maxLon,maxLat with longitudes in [-180, 180], "
+                      "latitudes in [-90, 90], minLat < maxLat and a longitude span under 180 degrees")
+        try:
+            min_lon, min_lat, max_lon, max_lat = (float(v) for v in bbox_param.split(','))
+        except ValueError:
+            raise ValueError(bbox_error)
+        # Reject boxes MongoDB would refuse (NaN/inf, out of range, zero size) so they get a 400, not a 500.
+        # A single-ring polygon spanning 180+ degrees is bigger than a hemisphere, and MongoDB would then
+        # silently query the complementary area, so those are rejected too.
+        # minLon > maxLon is allowed and means the box crosses the antimeridian.
+        lon_span = (max_lon - min_lon) % 360
+        if not (all(math.isfinite(v) for v in (min_lon, min_lat, max_lon, max_lat))
+                and -180 <= min_lon <= 180 and -180 <= max_lon <= 180
+                and -90 <= min_lat < max_lat <= 90
+                and 0 < lon_span < 180):
+            raise ValueError(bbox_error)
+        query["location"] = {"$geoWithin": {"$geometry": {
+            "type": "Polygon",
+            "coordinates": [[[min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat],
+                             [min_lon, max_lat], [min_lon, min_lat]]],
+        }}}
+
+    # Storm + area filters, shared by the fallback query below
+    base_query = dict(query)
+
     # --- Time Filtering Logic ---
     if timestamp_param:
         # Find the single point closest IN TIME to the requested timestamp
-        # Note: This requires the timestamp index on MongoDB is created
+        # Note: This relies on the "storm_time" (storm_id, timestamp) index created by load_track_data.py
         try:
-            target_time = datetime.fromisoformat(timestamp_param.replace('Z', '+00:00'))
-            # Find the record immediately before or at the target time
-            cursor = collection.find({
-                "storm_id": storm_id_param,
-                "timestamp": {"$lte": target_time.strftime("%Y-%m-%dT%H:%M:%SZ")}
-            }).sort("timestamp", pymongo.DESCENDING).limit(1)
-            # We take the *latest* point at or before the requested time
-            result = list(cursor) # Execute query and get result list
-            if not result: # If no points before, try finding the earliest point overall
-                 cursor = collection.find({"storm_id": storm_id_param}).sort("timestamp", pymongo.ASCENDING).limit(1)
-                 result = list(cursor)
-
+            target_time = ciso8601.parse_datetime(timestamp_param)
         except ValueError:
-            return jsonify({"error": "Invalid timestamp format. Use ISO format like YYYY-MM-DDTHH:MM:SSZ"}), 400
-        except Exception as e:
-            print(f"Error querying single timestamp: {e}")
-            return jsonify({"error": "Database query failed"}), 500
+            raise ValueError("Invalid timestamp format. Use ISO format like YYYY-MM-DDTHH:MM:SSZ")
+        query["timestamp"] = {"$lte": target_time}
+        return [
+            # We take the *latest* point at or before the requested time
+            feature_pipeline(query, pymongo.DESCENDING, limit=1),
+            # If no points before, fall back to the earliest point overall
+            feature_pipeline(base_query, pymongo.ASCENDING, limit=1),
+        ]
 
-    elif start_time_param and end_time_param:
+    if start_time_param and end_time_param:
         # Find all points within a time range
         try:
-            start_time = datetime.fromisoformat(start_time_param.replace('Z', '+00:00'))
-            end_time = datetime.fromisoformat(end_time_param.replace('Z', '+00:00'))
-            query["timestamp"] = {
-                "$gte": start_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
-                "$lte": end_time.strftime("%Y-%m-%dT%H:%M:%SZ")
-            }
-            cursor = collection.find(query).sort("timestamp", pymongo.ASCENDING)
-            result = list(cursor) # Execute query
-
+            start_time = ciso8601.parse_datetime(start_time_param)
+            end_time = ciso8601.parse_datetime(end_time_param)
         except ValueError:
-             return jsonify({"error": "Invalid start/end time format. Use ISO format like YYYY-MM-DDTHH:MM:SSZ"}), 400
-        except Exception as e:
-            print(f"Error querying time range: {e}")
-            return jsonify({"error": "Database query failed"}), 500
-    else:
-        # No time filter, get all points for the storm
-        try:
-             cursor = collection.find(query).sort("timestamp", pymongo.ASCENDING)
-             result = list(cursor) # Execute query
-        except Exception as e:
-             print(f"Error querying all data: {e}")
-             return jsonify({"error": "Database query failed"}), 500
-
-    # --- Convert MongoDB results to GeoJSON Features ---
-    for point_data in result:
-        # Basic properties to include
-        properties = {
-            "timestamp": point_data.get("timestamp"),
-            "wind_kts": point_data.get("wind_kts"),
-            "pressure_mb": point_data.get("pressure_mb"),
-            "storm_id": point_data.get("storm_id"),
-            # Add more properties if needed
-        }
-        # Create GeoJSON Point geometry
-        geometry = point_data.get("location") # Use the pre-formatted GeoJSON location
-
-        # Create GeoJSON Feature
-        if geometry: # Only create feature if geometry exists
-             feature = geojson.Feature(geometry=geometry, properties=properties)
-             features.append(feature)
-
-    # Create GeoJSON FeatureCollection
-    feature_collection = geojson.FeatureCollection(features)
-
-    # Return the FeatureCollection as JSON
-    return jsonify(feature_collection)
+            raise ValueError("Invalid start/end time format. Use ISO format like YYYY-MM-DDTHH:MM:SSZ")
+        # Timestamps are stored as BSON Dates, so pass the datetimes straight through
+        query["timestamp"] = {"$gte": start_time, "$lte": end_time}
+
+    # Otherwise no time filter, get all points for the storm
+    return [feature_pipeline(query)]
+
+# --- API Endpoints ---
+
+@app.route('/') # Default route
+def index():
+    return "StormSight AI Prototype Backend is running!"
+
+@app.route('/track_data') # Route to get track data
+def get_track_data():
+    """
+    Fetches track data from MongoDB based on optional time parameters.
+    Returns data as a GeoJSON FeatureCollection.
+    Example query: /track_data?timestamp=2020-11-25T12:00:00Z
+                   /track_data?start=2020-11-24T00:00:00Z&end=2020-11-26T00:00:00Z
+                   /track_data?bbox=80,10,90,20 (minLon,minLat,maxLon,maxLat; combines with the above)
+    The bbox polygon's edges are geodesic (great-circle arcs), so for large boxes the north/south
+    edges bow away from the lines of latitude and the matched area is not an exact lat/lon rectangle.
+    """
+    collection = get_db_collection()
+    try:
+        pipelines = build_track_pipelines(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        features = []
+        for pipeline in pipelines:
+            features = list(collection.aggregate(pipeline)) # Execute query and get result list
+            if features:
+                break
+    except Exception as e:
+        print(f"Error querying track data: {e}")
+        return jsonify({"error": "Database query failed"}), 500
+
+    # Create GeoJSON FeatureCollection (features arrive already shaped by the pipeline)
+    feature_collection = {"type": "FeatureCollection", "features": features}
+
+    # Return the FeatureCollection as JSON (orjson is much faster than jsonify for big payloads)
+    return app.response_class(orjson.dumps(feature_collection), mimetype="application/json")
+
+@app.route('/track_data.ndjson') # Streaming variant for large time ranges
+def get_track_data_stream():
+    """
+    Same parameters as /track_data, but streams the features as GeoJSON Text Sequences (RFC 8142):
+    each feature is written as <RS>{json}<LF> straight from the MongoDB cursor, so the full
+    result is never held in memory and clients can start parsing before the query finishes.
+    """
+    collection = get_db_collection()
+    try:
+        pipelines = build_track_pipelines(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        # Open the first cursor up front so database errors still become a proper 500
+        cursor = collection.aggregate(pipelines[0])
+    except Exception as e:
+        print(f"Error querying track data: {e}")
+        return jsonify({"error": "Database query failed"}), 500
+
+    def generate():
+        found = False
+        for feature in cursor: # PyMongo fetches in batches, so memory stays bounded
+            found = True
+            yield b"\x1e" + orjson.dumps(feature) + b"\n"
+        for pipeline in pipelines[1:]: # Fallback queries only run if nothing matched
+            if found:
+                break
+            for feature in collection.aggregate(pipeline):
+                found = True
+                yield b"\x1e" + orjson.dumps(feature) + b"\n"
+
+    return Response(generate(), mimetype="application/geo+json-seq")
 
 
 # --- Main execution ---
 if __name__ == '__main__':
-    get_db_collection() # Try initial DB connection when starting
+    try:
+        db_client.admin.command('ping') # Check connection when starting
+        print("MongoDB connection successful for API.")
+    except Exception as e:
+        print(f"ERROR: Could not connect to MongoDB for API. {e}")
     print("Starting Flask backend server...")
     # Run on port 5000, accessible from any IP on your network (0.0.0.0)
-    # Use debug=True only for development (auto-reloads on code changes)
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    # Debug mode (auto-reload, single process) only when asked for, e.g. FLASK_DEBUG=1 python backend.py
+    # For production, run under a WSGI server with cooperative workers so MongoDB waits overlap, e.g.:
+    #   gunicorn -k gevent -w 4 backend:app
+    debug_mode = os.getenv("FLASK_DEBUG", "").lower() in ("1", "true", "yes")
+    app.run(host='0.0.0.0', port=5000, debug=debug_mode)
\ No newline at end of file